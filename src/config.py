@@ -51,6 +51,12 @@ CFL = 1.587 / 2
 # Output timestep (in seconds or as a time string)
 OUTPUT_TIMESTEP = '1 day'  # Note: it will be rounded to a multiple of dt
 
+# Array backend: 'numpy' (CPU) or 'cupy' (GPU, requires CuPy)
+BACKEND = 'numpy'
+
+# Number of threads of the compiled kernels (None to use all cores, requires Numba)
+NUM_THREADS = None
+
 # Enable/disable logs
 LOG = True
 
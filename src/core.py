@@ -3,78 +3,159 @@
 import numpy as np
 
 
-def ddx(z, dx):
-    """Compute x derivative of array z."""
-    return (z[:, 1:] - z[:, :-1]) / dx
-
-
-def ddy(z, dy):
-    """Compute y derivative of array z."""
-    return (z[1:, :] - z[:-1, :]) / dy
-
-
-def avx(z):
-    """Reduce x length of z by calculating the average of consecutive cells."""
-    return (z[:, 1:] + z[:, :-1]) * 0.5
-
-
-def avy(z):
-    """Reduce y length of z by calculating the average of consecutive cells."""
-    return (z[1:, :] + z[:-1, :]) * 0.5
-
-
-def curl(u, v, dx, dy):
-    """Compute curl of u and v."""
-    omega = np.zeros((v.shape[0], u.shape[1]))
-    omega[1:-1, :] = ddy(u, dy)
-    omega[:, 1:-1] -= ddx(v, dx)
-    return omega
-
-
-def rhs(state, f, g, h_0, dx, dy):
+def ddx(z, dx, out=None):
+    """Compute x derivative of array z (in `out` if given)."""
+    if out is None:
+        return (z[:, 1:] - z[:, :-1]) / dx
+    np.subtract(z[:, 1:], z[:, :-1], out=out)
+    out /= dx
+    return out
+
+
+def ddy(z, dy, out=None):
+    """Compute y derivative of array z (in `out` if given)."""
+    if out is None:
+        return (z[1:, :] - z[:-1, :]) / dy
+    np.subtract(z[1:, :], z[:-1, :], out=out)
+    out /= dy
+    return out
+
+
+def avx(z, out=None):
+    """Reduce x length of z by calculating the average of consecutive cells (in `out` if given)."""
+    if out is None:
+        return (z[:, 1:] + z[:, :-1]) * 0.5
+    np.add(z[:, 1:], z[:, :-1], out=out)
+    out *= 0.5
+    return out
+
+
+def avy(z, out=None):
+    """Reduce y length of z by calculating the average of consecutive cells (in `out` if given)."""
+    if out is None:
+        return (z[1:, :] + z[:-1, :]) * 0.5
+    np.add(z[1:, :], z[:-1, :], out=out)
+    out *= 0.5
+    return out
+
+
+def curl(u, v, dx, dy, out=None, tmp=None):
+    """Compute curl of u and v.
+    If given, the curl is written in `out` and `tmp` (of shape (ny + 1, nx - 1)) stores the x derivative of v."""
+    if out is None:
+        # zeros_like allocates omega with the same array module as u (NumPy or CuPy)
+        out = np.zeros_like(u, shape=(v.shape[0], u.shape[1]))
+    else:
+        out[0, :] = 0
+        out[-1, :] = 0
+    ddy(u, dy, out=out[1:-1, :])
+    out[:, 1:-1] -= ddx(v, dx, out=tmp)
+    return out
+
+
+def make_scratch(ny, nx, dtype=np.float64):
+    """Allocate the temporary arrays used by `rhs` on a (ny, nx) grid."""
+    return {
+        'h_tot': np.empty((ny, nx), dtype=dtype),
+        'h_tmp': np.empty((ny, nx), dtype=dtype),
+        'b': np.empty((ny, nx), dtype=dtype),
+        # Boundaries of h_x and h_y are never written and stay null
+        'h_x': np.zeros((ny, nx + 1), dtype=dtype),
+        'h_y': np.zeros((ny + 1, nx), dtype=dtype),
+        'flux_x': np.empty((ny, nx + 1), dtype=dtype),
+        'flux_y': np.empty((ny + 1, nx), dtype=dtype),
+        'omega': np.empty((ny + 1, nx + 1), dtype=dtype),
+        'dvdx': np.empty((ny + 1, nx - 1), dtype=dtype),
+        'omega_u': np.empty((ny, nx - 1), dtype=dtype),
+        'omega_v': np.empty((ny - 1, nx), dtype=dtype),
+        'v_x': np.empty((ny + 1, nx - 1), dtype=dtype),
+        'v_xy': np.empty((ny, nx - 1), dtype=dtype),
+        'u_y': np.empty((ny - 1, nx + 1), dtype=dtype),
+        'u_yx': np.empty((ny - 1, nx), dtype=dtype),
+    }
+
+
+def rhs(state, f, g, h_0, dx, dy, scratch=None):
     """Compute the RHS of the RSW equations.
     Input: state is a list of three arrays
-    Output: a list of three arrays with the tendencies"""
+    Output: a list of three arrays with the tendencies
+    Temporary arrays are taken from `scratch` (see `make_scratch`) if given."""
     h_, u_, v_ = state
-
-    h_x = np.zeros_like(u_)  # h with the same shape as u
-    h_y = np.zeros_like(v_)  # h with the same shape as v
-    h_x[:, 1:-1] = avx(h_0 + h_)
-    h_y[1:-1, :] = avy(h_0 + h_)
-
-    d_h = -(ddx(h_x * u_, dx) + ddy(h_y * v_, dy))
-
-    # Vorticity at corner cell
-    omega = f + curl(u_, v_, dx, dy)
-
-    # Bernoulli function
-    b = g * h_ + 0.5 * (avx(u_**2) + avy(v_**2))
+    ny, nx = h_.shape
+    s = make_scratch(ny, nx, h_.dtype) if scratch is None else scratch
+
+    h_tot = np.add(h_, h_0, out=s['h_tot'])
+    h_x = s['h_x']  # h with the same shape as u
+    h_y = s['h_y']  # h with the same shape as v
+    avx(h_tot, out=h_x[:, 1:-1])
+    avy(h_tot, out=h_y[1:-1, :])
+
+    d_h = ddx(np.multiply(h_x, u_, out=s['flux_x']), dx, out=np.empty_like(h_))
+    d_h += ddy(np.multiply(h_y, v_, out=s['flux_y']), dy, out=s['h_tmp'])
+    np.negative(d_h, out=d_h)
+
+    # Vorticity at corner cell, averaged on the u and v grids
+    omega = curl(u_, v_, dx, dy, out=s['omega'], tmp=s['dvdx'])
+    omega += f
+    omega_u = avy(omega[:, 1:-1], out=s['omega_u'])
+    omega_v = avx(omega[1:-1, :], out=s['omega_v'])
+
+    # Bernoulli function (u and v squares are stored in the fluxes buffers)
+    u_sq = np.multiply(u_, u_, out=s['flux_x'])
+    v_sq = np.multiply(v_, v_, out=s['flux_y'])
+    b = avx(u_sq, out=s['b'])
+    b += avy(v_sq, out=s['h_tmp'])
+    b *= 0.5
+    b += np.multiply(h_, g, out=s['h_tmp'])
 
     du = np.zeros_like(u_)
     dv = np.zeros_like(v_)
 
     # Centered discretization
-    du[:, 1:-1] = -ddx(b, dx) + avy(omega[:, 1:-1]) * avy(avx(v_))
-    dv[1:-1, :] = -ddy(b, dy) - avx(omega[1:-1, :]) * avx(avy(u_))
+    coriolis_u = np.multiply(omega_u, avy(avx(v_, out=s['v_x']), out=s['v_xy']), out=s['v_xy'])
+    np.subtract(coriolis_u, ddx(b, dx, out=du[:, 1:-1]), out=du[:, 1:-1])
+    coriolis_v = np.multiply(omega_v, avx(avy(u_, out=s['u_y']), out=s['u_yx']), out=s['u_yx'])
+    np.negative(np.add(ddy(b, dy, out=dv[1:-1, :]), coriolis_v, out=dv[1:-1, :]), out=dv[1:-1, :])
 
     return d_h, du, dv
 
 
-def rk3(h, u, v, dt, f, g, h_0, dx, dy):
+def rk3(h, u, v, dt, f, g, h_0, dx, dy, sponge_u=None, sponge_v=None, scratch=None):
+    """Run one RK3 step and return the new h, u, v.
+    If given, the sponge coefficients (see `damp`) damp u and v at the end of the step and `scratch` is passed to `rhs`."""
     state = h, u, v
-    ds0 = rhs(state, f, g, h_0, dx, dy)
+    ds0 = rhs(state, f, g, h_0, dx, dy, scratch)
     s0 = [x + y * dt for x, y in zip(state, ds0)]
 
-    ds1 = rhs(s0, f, g, h_0, dx, dy)
+    ds1 = rhs(s0, f, g, h_0, dx, dy, scratch)
     s1 = [x + (y + z) * (dt / 4) for x, y, z in zip(state, ds0, ds1)]
 
-    ds2 = rhs(s1, f, g, h_0, dx, dy)
+    ds2 = rhs(s1, f, g, h_0, dx, dy, scratch)
     state = [
         x + (w + y + 4 * z) * (dt / 6) for x, w, y, z in zip(state, ds0, ds1, ds2)
     ]
+    if sponge_u is not None:
+        damp(state[1], sponge_u)
+    if sponge_v is not None:
+        damp(state[2], sponge_v)
     return state
 
 
+def sponge_band(sponge):
+    """Return the flat indices and the coefficients of the points damped by a sponge (coefficient < 1)."""
+    idx = np.flatnonzero(sponge < 1)
+    return idx, sponge.ravel()[idx]
+
+
+def damp(z, sponge):
+    """Multiply contiguous z in place by sponge coefficients, given as an array or as a band (see `sponge_band`)."""
+    if isinstance(sponge, tuple):
+        idx, coef = sponge
+        z.reshape(-1)[idx] *= coef
+    else:
+        z *= sponge
+
+
 def pv(u, v, h_tot, f, dx, dy):
     """Compute potential vorticity.
     Here h_tot is the total thickness of the layer, i.e. h + h_0."""
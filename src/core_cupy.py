@@ -0,0 +1,156 @@
+"""Core of the simulation on GPU with CuPy.
+The RHS of the RSW equations is computed by a single CUDA kernel, one thread per grid point."""
+
+from functools import lru_cache
+
+import numpy as np
+import cupy as cp
+
+# Block of threads (x, y) used to launch the kernels
+BLOCK = (32, 8)
+
+# h[j, i], u[j, i] and v[j, i] are the center, west face and south face of cell (j, i) and f[j, i] its south-west corner
+_SOURCE = r'''
+#define H(a, j, i) a[(j) * nx + (i)]
+#define U(a, j, i) a[(j) * (nx + 1) + (i)]
+#define V(a, j, i) a[(j) * nx + (i)]
+#define F(a, j, i) a[(j) * (nx + 1) + (i)]
+
+__device__ real flux_x(const real* h, const real* u, const real h_0, const int nx, const int j, const int i)
+{
+    if (i == 0 || i == nx) return 0;
+    return (h_0 + (real)0.5 * (H(h, j, i - 1) + H(h, j, i))) * U(u, j, i);
+}
+
+__device__ real flux_y(const real* h, const real* v, const real h_0, const int ny, const int nx, const int j, const int i)
+{
+    if (j == 0 || j == ny) return 0;
+    return (h_0 + (real)0.5 * (H(h, j - 1, i) + H(h, j, i))) * V(v, j, i);
+}
+
+__device__ real omega(const real* u, const real* v, const real* f, const real dx, const real dy,
+                      const int ny, const int nx, const int j, const int i)
+{
+    real om = F(f, j, i);
+    if (j > 0 && j < ny) om += (U(u, j, i) - U(u, j - 1, i)) / dy;
+    if (i > 0 && i < nx) om -= (V(v, j, i) - V(v, j, i - 1)) / dx;
+    return om;
+}
+
+__device__ real bernoulli(const real* h, const real* u, const real* v, const real g, const int nx, const int j, const int i)
+{
+    const real u0 = U(u, j, i), u1 = U(u, j, i + 1), v0 = V(v, j, i), v1 = V(v, j + 1, i);
+    return g * H(h, j, i) + (real)0.25 * (u0 * u0 + u1 * u1 + v0 * v0 + v1 * v1);
+}
+
+__device__ void tendencies(const real* h, const real* u, const real* v, const real* f,
+                           const real g, const real h_0, const real dx, const real dy,
+                           const int ny, const int nx, const int j, const int i,
+                           real* d_h, real* d_u, real* d_v)
+{
+    *d_h = 0;
+    *d_u = 0;
+    *d_v = 0;
+    if (j < ny && i < nx)
+        *d_h = -((flux_x(h, u, h_0, nx, j, i + 1) - flux_x(h, u, h_0, nx, j, i)) / dx
+                 + (flux_y(h, v, h_0, ny, nx, j + 1, i) - flux_y(h, v, h_0, ny, nx, j, i)) / dy);
+    if (j < ny && i > 0 && i < nx)
+        *d_u = -(bernoulli(h, u, v, g, nx, j, i) - bernoulli(h, u, v, g, nx, j, i - 1)) / dx
+               + (real)0.5 * (omega(u, v, f, dx, dy, ny, nx, j, i) + omega(u, v, f, dx, dy, ny, nx, j + 1, i))
+               * (real)0.25 * (V(v, j, i - 1) + V(v, j, i) + V(v, j + 1, i - 1) + V(v, j + 1, i));
+    if (j > 0 && j < ny && i < nx)
+        *d_v = -(bernoulli(h, u, v, g, nx, j, i) - bernoulli(h, u, v, g, nx, j - 1, i)) / dy
+               - (real)0.5 * (omega(u, v, f, dx, dy, ny, nx, j, i) + omega(u, v, f, dx, dy, ny, nx, j, i + 1))
+               * (real)0.25 * (U(u, j - 1, i) + U(u, j - 1, i + 1) + U(u, j, i) + U(u, j, i + 1));
+}
+
+extern "C" __global__
+void rhs(const real* h, const real* u, const real* v, const real* f,
+         const real g, const real h_0, const real dx, const real dy, const int ny, const int nx,
+         real* dh, real* du, real* dv)
+{
+    const int i = blockDim.x * blockIdx.x + threadIdx.x;
+    const int j = blockDim.y * blockIdx.y + threadIdx.y;
+    if (j > ny || i > nx) return;
+    real d_h, d_u, d_v;
+    tendencies(h, u, v, f, g, h_0, dx, dy, ny, nx, j, i, &d_h, &d_u, &d_v);
+    if (j < ny && i < nx) H(dh, j, i) = d_h;
+    if (j < ny) U(du, j, i) = d_u;
+    if (i < nx) V(dv, j, i) = d_v;
+}
+
+// Compute the tendencies k of state s and update acc = acc + w * k and out = state + c * acc
+extern "C" __global__
+void rk3_stage(const real* s_h, const real* s_u, const real* s_v, const real* h, const real* u, const real* v,
+               const real* f, const real g, const real h_0, const real dx, const real dy, const int ny, const int nx,
+               real* acc_h, real* acc_u, real* acc_v, real* out_h, real* out_u, real* out_v, const real w, const real c)
+{
+    const int i = blockDim.x * blockIdx.x + threadIdx.x;
+    const int j = blockDim.y * blockIdx.y + threadIdx.y;
+    if (j > ny || i > nx) return;
+    real d_h, d_u, d_v;
+    tendencies(s_h, s_u, s_v, f, g, h_0, dx, dy, ny, nx, j, i, &d_h, &d_u, &d_v);
+    if (j < ny && i < nx) {
+        H(acc_h, j, i) += w * d_h;
+        H(out_h, j, i) = H(h, j, i) + c * H(acc_h, j, i);
+    }
+    if (j < ny) {
+        U(acc_u, j, i) += w * d_u;
+        U(out_u, j, i) = U(u, j, i) + c * U(acc_u, j, i);
+    }
+    if (i < nx) {
+        V(acc_v, j, i) += w * d_v;
+        V(out_v, j, i) = V(v, j, i) + c * V(acc_v, j, i);
+    }
+}
+'''
+
+_C_TYPES = {np.dtype(np.float32): 'float', np.dtype(np.float64): 'double'}
+
+
+@lru_cache
+def _module(dtype):
+    """Compile the kernels for the given floating point type."""
+    return cp.RawModule(code=f'typedef {_C_TYPES[dtype]} real;\n' + _SOURCE)
+
+
+def _grid(ny, nx):
+    """Return the grid of blocks covering the (ny + 1, nx + 1) points."""
+    return (nx + BLOCK[0]) // BLOCK[0], (ny + BLOCK[1]) // BLOCK[1]
+
+
+def rhs(state, f, g, h_0, dx, dy):
+    """Compute the RHS of the RSW equations (see `core.rhs`)."""
+    h_, u_, v_ = state
+    ny, nx = h_.shape
+    real = h_.dtype.type
+    dh, du, dv = cp.empty_like(h_), cp.empty_like(u_), cp.empty_like(v_)
+    kernel = _module(h_.dtype).get_function('rhs')
+    kernel(_grid(ny, nx), BLOCK, (h_, u_, v_, f, real(g), real(h_0), real(dx), real(dy),
+                                  np.int32(ny), np.int32(nx), dh, du, dv))
+    return dh, du, dv
+
+
+def rk3(h, u, v, dt, f, g, h_0, dx, dy, sponge_u=None, sponge_v=None):
+    """Run one RK3 step (see `core.rk3`) and return the new h, u, v.
+    If given, the sponge coefficients damp u and v at the end of the step."""
+    ny, nx = h.shape
+    real = h.dtype.type
+    kernel = _module(h.dtype).get_function('rk3_stage')
+    params = (f, real(g), real(h_0), real(dx), real(dy), np.int32(ny), np.int32(nx))
+
+    acc = cp.zeros_like(h), cp.zeros_like(u), cp.zeros_like(v)
+    s0 = cp.empty_like(h), cp.empty_like(u), cp.empty_like(v)
+    s1 = cp.empty_like(h), cp.empty_like(u), cp.empty_like(v)
+    state = h, u, v
+    grid = _grid(ny, nx)
+    kernel(grid, BLOCK, (*state, *state, *params, *acc, *s0, real(1), real(dt)))
+    kernel(grid, BLOCK, (*s0, *state, *params, *acc, *s1, real(1), real(dt / 4)))
+    # s0 is not needed anymore and stores the new state
+    kernel(grid, BLOCK, (*s1, *state, *params, *acc, *s0, real(4), real(dt / 6)))
+    h_new, u_new, v_new = s0
+    if sponge_u is not None:
+        u_new *= sponge_u
+    if sponge_v is not None:
+        v_new *= sponge_v
+    return h_new, u_new, v_new
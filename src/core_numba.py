@@ -0,0 +1,299 @@
+"""Core of the simulation compiled with Numba.
+The stencils of `core.rhs` are fused in a single loop over the grid so that no temporary array is allocated.
+The grid is processed by tiles whose Bernoulli function and vorticity are kept in small work arrays fitting in cache.
+On large grids, the state of a tile is also copied to work arrays and the three RK3 stages of a tile are computed
+before moving to the next one (see `rk3_blocked_into`).
+Constants are cast to the type of the arrays (`real`) so that single precision is not promoted to double precision.
+The time stepping takes the stage coefficients and the inverse grid steps precomputed (see `rk3_constants`),
+so that the stencils only multiply.
+
+Point (j, i) refers to the center of cell (j, i) for h, its west face for u, its south face for v
+and its south-west corner for the vorticity. Work arrays of a tile are stored with an offset (oj, oi),
+i.e. the value of point (j, i) is at index [j - oj, i - oi]. The Bernoulli function and vorticity have their own
+offset (pj, pi), so that the state can be read from the global arrays (offset 0)."""
+
+import numpy as np
+from numba import njit, prange, set_num_threads
+
+from config import NUM_THREADS
+
+if NUM_THREADS is not None:
+    set_num_threads(NUM_THREADS)
+
+# Tile size (rows, columns) and width of the halo of the work arrays
+TY = 64
+TX = 64
+HALO = 3
+# Number of work arrays of a tile: initial state, two intermediate states, accumulated tendencies, b and omega
+N_WORK = 14
+# Size in bytes of the state (h, u, v) above which the RK3 stages are blocked per tile, i.e. when the state
+# does not fit in cache anymore (below, the redundant halo computations of the blocked kernel are not paid back)
+BLOCKED_MIN_BYTES = 8 * 2**20
+
+
+@njit(fastmath=True, cache=True, inline='always')
+def _flux_x(h, u, h_0, nx, oj, oi, j, i):
+    """Compute the mass flux through the west face of cell (j, i)."""
+    real = h.dtype.type
+    if i == 0 or i == nx:
+        return real(0)
+    return (h_0 + real(0.5) * (h[j - oj, i - oi - 1] + h[j - oj, i - oi])) * u[j - oj, i - oi]
+
+
+@njit(fastmath=True, cache=True, inline='always')
+def _flux_y(h, v, h_0, ny, oj, oi, j, i):
+    """Compute the mass flux through the south face of cell (j, i)."""
+    real = h.dtype.type
+    if j == 0 or j == ny:
+        return real(0)
+    return (h_0 + real(0.5) * (h[j - oj - 1, i - oi] + h[j - oj, i - oi])) * v[j - oj, i - oi]
+
+
+@njit(fastmath=True, cache=True, inline='always')
+def _omega(u, v, f, inv_dx, inv_dy, ny, nx, oj, oi, j, i):
+    """Compute the vorticity (f + curl) at the south-west corner of cell (j, i).
+    f is stored without offset."""
+    omega = f[j, i]
+    if 0 < j < ny:
+        omega += (u[j - oj, i - oi] - u[j - oj - 1, i - oi]) * inv_dy
+    if 0 < i < nx:
+        omega -= (v[j - oj, i - oi] - v[j - oj, i - oi - 1]) * inv_dx
+    return omega
+
+
+@njit(fastmath=True, cache=True, inline='always')
+def _bernoulli(h, u, v, g, oj, oi, j, i):
+    """Compute the Bernoulli function at the center of cell (j, i)."""
+    lj, li = j - oj, i - oi
+    return g * h[lj, li] + h.dtype.type(0.25) * (u[lj, li]**2 + u[lj, li + 1]**2 + v[lj, li]**2 + v[lj + 1, li]**2)
+
+
+@njit(fastmath=True, cache=True, inline='always')
+def _n_tiles(ny, nx):
+    """Return the number of tiles covering the (ny + 1, nx + 1) points of the grid."""
+    return ((ny + TY) // TY) * ((nx + TX) // TX)
+
+
+@njit(fastmath=True, cache=True, inline='always')
+def _tile(t, ny, nx):
+    """Return the bounds j0, j1, i0, i1 of tile number t."""
+    n_i = (nx + TX) // TX
+    j0 = (t // n_i) * TY
+    i0 = (t % n_i) * TX
+    return j0, min(j0 + TY, ny + 1), i0, min(i0 + TX, nx + 1)
+
+
+@njit(fastmath=True, cache=True, inline='always')
+def _expand(j0, j1, i0, i1, n, ny, nx):
+    """Return the bounds of region [j0, j1) x [i0, i1) expanded by n points (and limited to the grid)."""
+    return max(j0 - n, 0), min(j1 + n, ny + 1), max(i0 - n, 0), min(i1 + n, nx + 1)
+
+
+@njit(fastmath=True, cache=True, inline='always')
+def _copy_state(h, u, v, oj, oi, out_h, out_u, out_v, pj, pi, r0, r1, c0, c1, ny, nx):
+    """Copy region [r0, r1) x [c0, c1) of h, u, v (stored with offset (oj, oi))
+    to out_h, out_u, out_v (stored with offset (pj, pi)). Only the points of each grid are copied."""
+    for j in range(r0, r1):
+        for i in range(c0, c1):
+            if j < ny:
+                out_u[j - pj, i - pi] = u[j - oj, i - oi]
+                if i < nx:
+                    out_h[j - pj, i - pi] = h[j - oj, i - oi]
+            if i < nx:
+                out_v[j - pj, i - pi] = v[j - oj, i - oi]
+
+
+@njit(fastmath=True, cache=True, inline='always')
+def _store_state(h, u, v, oj, oi, sponge_u, sponge_v, out_h, out_u, out_v, r0, r1, c0, c1, ny, nx):
+    """Copy region [r0, r1) x [c0, c1) of h, u, v (stored with offset (oj, oi)) to out_h, out_u, out_v,
+    u and v being damped by the sponge coefficients."""
+    for j in range(r0, r1):
+        for i in range(c0, c1):
+            if j < ny:
+                out_u[j, i] = u[j - oj, i - oi] * sponge_u[j, i]
+                if i < nx:
+                    out_h[j, i] = h[j - oj, i - oi]
+            if i < nx:
+                out_v[j, i] = v[j - oj, i - oi] * sponge_v[j, i]
+
+
+@njit(fastmath=True, cache=True, inline='always')
+def _work_arrays(h, u, v, f, g, inv_dx, inv_dy, ny, nx, oj, oi, pj, pi, r0, r1, c0, c1, b, om):
+    """Compute the Bernoulli function b and vorticity om (stored with offset (pj, pi))
+    needed by the tendencies of region [r0, r1) x [c0, c1)."""
+    for j in range(max(r0 - 1, 0), min(r1, ny)):
+        for i in range(max(c0 - 1, 0), min(c1, nx)):
+            b[j - pj, i - pi] = _bernoulli(h, u, v, g, oj, oi, j, i)
+    for j in range(r0, min(r1 + 1, ny + 1)):
+        for i in range(c0, min(c1 + 1, nx + 1)):
+            om[j - pj, i - pi] = _omega(u, v, f, inv_dx, inv_dy, ny, nx, oj, oi, j, i)
+
+
+@njit(fastmath=True, cache=True, inline='always')
+def _tendencies(h, u, v, b, om, h_0, inv_dx, inv_dy, ny, nx, oj, oi, pj, pi, j, i):
+    """Compute the tendencies of h, u and v at point (j, i).
+    Tendencies of points outside of their grid or on a closed boundary are 0."""
+    real = h.dtype.type
+    lj, li = j - oj, i - oi
+    bj, bi = j - pj, i - pi
+    d_h = real(0)
+    d_u = real(0)
+    d_v = real(0)
+    if j < ny and i < nx:
+        d_h = -((_flux_x(h, u, h_0, nx, oj, oi, j, i + 1) - _flux_x(h, u, h_0, nx, oj, oi, j, i)) * inv_dx
+                + (_flux_y(h, v, h_0, ny, oj, oi, j + 1, i) - _flux_y(h, v, h_0, ny, oj, oi, j, i)) * inv_dy)
+    if j < ny and 0 < i < nx:
+        d_u = (-(b[bj, bi] - b[bj, bi - 1]) * inv_dx
+               + real(0.5) * (om[bj, bi] + om[bj + 1, bi])
+               * real(0.25) * (v[lj, li - 1] + v[lj, li] + v[lj + 1, li - 1] + v[lj + 1, li]))
+    if 0 < j < ny and i < nx:
+        d_v = (-(b[bj, bi] - b[bj - 1, bi]) * inv_dy
+               - real(0.5) * (om[bj, bi] + om[bj, bi + 1])
+               * real(0.25) * (u[lj - 1, li] + u[lj - 1, li + 1] + u[lj, li] + u[lj, li + 1]))
+    return d_h, d_u, d_v
+
+
+@njit(parallel=True, fastmath=True, cache=True, nogil=True)
+def rhs_kernel(h, u, v, f, g, h_0, dx, dy, dh, du, dv):
+    """Compute the RHS of the RSW equations (see `core.rhs`).
+    The tendencies are written in the preallocated arrays dh, du and dv."""
+    real = h.dtype.type
+    inv_dx, inv_dy = real(1 / dx), real(1 / dy)
+    ny, nx = h.shape
+    for t in prange(_n_tiles(ny, nx)):
+        j0, j1, i0, i1 = _tile(t, ny, nx)
+        oj, oi = j0 - HALO, i0 - HALO
+        work = np.empty((5, TY + 2 * HALO, TX + 2 * HALO), dtype=h.dtype)
+        s_h, s_u, s_v, b, om = work[0], work[1], work[2], work[3], work[4]
+        r0, r1, c0, c1 = _expand(j0, j1, i0, i1, 1, ny, nx)
+        _copy_state(h, u, v, 0, 0, s_h, s_u, s_v, oj, oi, r0, r1, c0, c1, ny, nx)
+        _work_arrays(s_h, s_u, s_v, f, g, inv_dx, inv_dy, ny, nx, oj, oi, oj, oi, j0, j1, i0, i1, b, om)
+        for j in range(j0, j1):
+            for i in range(i0, i1):
+                d_h, d_u, d_v = _tendencies(s_h, s_u, s_v, b, om, h_0, inv_dx, inv_dy, ny, nx, oj, oi, oj, oi, j, i)
+                if j < ny and i < nx:
+                    dh[j, i] = d_h
+                if j < ny:
+                    du[j, i] = d_u
+                if i < nx:
+                    dv[j, i] = d_v
+
+
+@njit(fastmath=True, cache=True, inline='always')
+def _rk3_stage(s, x, acc, out, b, om, f, g, h_0, inv_dx, inv_dy, ny, nx, oj, oi, pj, pi, r0, r1, c0, c1, w, c, first):
+    """Compute the tendencies k of state s on region [r0, r1) x [c0, c1) and update in the same pass:
+    acc = acc + w * k (acc = w * k for the first stage) and out = x + c * acc"""
+    s_h, s_u, s_v = s
+    x_h, x_u, x_v = x
+    acc_h, acc_u, acc_v = acc
+    out_h, out_u, out_v = out
+    _work_arrays(s_h, s_u, s_v, f, g, inv_dx, inv_dy, ny, nx, oj, oi, pj, pi, r0, r1, c0, c1, b, om)
+    for j in range(r0, r1):
+        for i in range(c0, c1):
+            d_h, d_u, d_v = _tendencies(s_h, s_u, s_v, b, om, h_0, inv_dx, inv_dy, ny, nx, oj, oi, pj, pi, j, i)
+            lj, li = j - oj, i - oi
+            if j < ny and i < nx:
+                acc_h[lj, li] = w * d_h if first else acc_h[lj, li] + w * d_h
+                out_h[lj, li] = x_h[lj, li] + c * acc_h[lj, li]
+            if j < ny:
+                acc_u[lj, li] = w * d_u if first else acc_u[lj, li] + w * d_u
+                out_u[lj, li] = x_u[lj, li] + c * acc_u[lj, li]
+            if i < nx:
+                acc_v[lj, li] = w * d_v if first else acc_v[lj, li] + w * d_v
+                out_v[lj, li] = x_v[lj, li] + c * acc_v[lj, li]
+
+
+@njit(fastmath=True, cache=True, inline='always')
+def _rk3_tile(t, h, u, v, f, sponge_u, sponge_v, c_0, c_1, c_2, g, h_0, inv_dx, inv_dy, out_h, out_u, out_v):
+    """Run one RK3 step on tile number t and write the new h, u, v damped by the sponge coefficients."""
+    real = h.dtype.type
+    ny, nx = h.shape
+    j0, j1, i0, i1 = _tile(t, ny, nx)
+    oj, oi = j0 - HALO, i0 - HALO
+    work = np.empty((N_WORK, TY + 2 * HALO, TX + 2 * HALO), dtype=h.dtype)
+    x = work[0], work[1], work[2]
+    s0 = work[3], work[4], work[5]
+    s1 = work[6], work[7], work[8]
+    acc = work[9], work[10], work[11]
+    b, om = work[12], work[13]
+
+    r0, r1, c0, c1 = _expand(j0, j1, i0, i1, 3, ny, nx)
+    _copy_state(h, u, v, 0, 0, x[0], x[1], x[2], oj, oi, r0, r1, c0, c1, ny, nx)
+    r0, r1, c0, c1 = _expand(j0, j1, i0, i1, 2, ny, nx)
+    _rk3_stage(x, x, acc, s0, b, om, f, g, h_0, inv_dx, inv_dy, ny, nx, oj, oi, oj, oi, r0, r1, c0, c1,
+               real(1), c_0, True)
+    r0, r1, c0, c1 = _expand(j0, j1, i0, i1, 1, ny, nx)
+    _rk3_stage(s0, x, acc, s1, b, om, f, g, h_0, inv_dx, inv_dy, ny, nx, oj, oi, oj, oi, r0, r1, c0, c1,
+               real(1), c_1, False)
+    # s0 is not needed anymore and stores the new state
+    _rk3_stage(s1, x, acc, s0, b, om, f, g, h_0, inv_dx, inv_dy, ny, nx, oj, oi, oj, oi, j0, j1, i0, i1,
+               real(4), c_2, False)
+    _store_state(s0[0], s0[1], s0[2], oj, oi, sponge_u, sponge_v, out_h, out_u, out_v, j0, j1, i0, i1, ny, nx)
+
+
+def rk3_constants(dt, g, h_0, dx, dy, dtype):
+    """Return the constants c_0, c_1, c_2, g, h_0, inv_dx, inv_dy of the RK3 kernels in the given dtype:
+    the coefficients dt, dt / 4, dt / 6 of the three stages, g, h_0 and the inverse grid steps."""
+    real = np.dtype(dtype).type
+    return real(dt), real(dt / 4), real(dt / 6), real(g), real(h_0), real(1 / dx), real(1 / dy)
+
+
+def make_scratch(ny, nx, dtype):
+    """Allocate the accumulated tendencies and the two intermediate states used by `rk3_kernel_into`."""
+    return tuple(np.empty(shape, dtype=dtype) for _ in range(3) for shape in ((ny, nx), (ny, nx + 1), (ny + 1, nx)))
+
+
+@njit(parallel=True, fastmath=True, cache=True, nogil=True)
+def _rk3_pass(s, x, acc, out, f, sponge_u, sponge_v, g, h_0, inv_dx, inv_dy, w, c, first, last):
+    """Run one RK3 stage (see `_rk3_stage`) on the whole grid, reading and writing the global arrays.
+    On the last stage, u and v are damped by the sponge coefficients."""
+    ny, nx = x[0].shape
+    for t in prange(_n_tiles(ny, nx)):
+        j0, j1, i0, i1 = _tile(t, ny, nx)
+        pj, pi = j0 - 1, i0 - 1
+        work = np.empty((2, TY + 2, TX + 2), dtype=x[0].dtype)
+        _rk3_stage(s, x, acc, out, work[0], work[1], f, g, h_0, inv_dx, inv_dy, ny, nx, 0, 0, pj, pi,
+                   j0, j1, i0, i1, w, c, first)
+        if last:
+            # The tile of out is still in cache and is damped in place
+            _store_state(out[0], out[1], out[2], 0, 0, sponge_u, sponge_v, out[0], out[1], out[2],
+                         j0, j1, i0, i1, ny, nx)
+
+
+@njit(fastmath=True, cache=True, nogil=True)
+def rk3_kernel_into(h, u, v, f, sponge_u, sponge_v, c_0, c_1, c_2, g, h_0, inv_dx, inv_dy,
+                    out_h, out_u, out_v, scratch):
+    """Run one RK3 step (see `core.rk3`) and write the new h, u, v, damped by the sponge coefficients,
+    in the preallocated out_h, out_u, out_v. The constants are given by `rk3_constants`
+    and `scratch` by `make_scratch`.
+    Each stage is a single pass over the grid, intermediate tendencies are accumulated in place."""
+    real = h.dtype.type
+    x = (h, u, v)
+    acc = (scratch[0], scratch[1], scratch[2])
+    s0 = (scratch[3], scratch[4], scratch[5])
+    s1 = (scratch[6], scratch[7], scratch[8])
+    out = (out_h, out_u, out_v)
+    _rk3_pass(x, x, acc, s0, f, sponge_u, sponge_v, g, h_0, inv_dx, inv_dy, real(1), c_0, True, False)
+    _rk3_pass(s0, x, acc, s1, f, sponge_u, sponge_v, g, h_0, inv_dx, inv_dy, real(1), c_1, False, False)
+    _rk3_pass(s1, x, acc, out, f, sponge_u, sponge_v, g, h_0, inv_dx, inv_dy, real(4), c_2, False, True)
+
+
+@njit(parallel=True, fastmath=True, cache=True, nogil=True)
+def rk3_blocked_into(h, u, v, f, sponge_u, sponge_v, c_0, c_1, c_2, g, h_0, inv_dx, inv_dy, out_h, out_u, out_v):
+    """Run one RK3 step like `rk3_kernel_into`, the three stages being computed tile by tile.
+    Tiles are independent: each tile copies its state with a halo of width 3 and computes the 3 stages
+    on a region shrinking by one point per stage (halos are computed redundantly by neighbouring tiles).
+    This way a tile stays in cache during the whole step instead of streaming the grid 3 times from memory,
+    which pays back the redundant computations only when the state does not fit in cache (see `BLOCKED_MIN_BYTES`)."""
+    ny, nx = h.shape
+    for t in prange(_n_tiles(ny, nx)):
+        _rk3_tile(t, h, u, v, f, sponge_u, sponge_v, c_0, c_1, c_2, g, h_0, inv_dx, inv_dy, out_h, out_u, out_v)
+
+
+def rk3_kernel(h, u, v, dt, f, g, h_0, dx, dy, sponge_u, sponge_v):
+    """Run one RK3 step (see `core.rk3`) with `rk3_kernel_into` and return the new h, u, v,
+    damped by the sponge coefficients."""
+    out = np.empty_like(h), np.empty_like(u), np.empty_like(v)
+    rk3_kernel_into(h, u, v, f, sponge_u, sponge_v, *rk3_constants(dt, g, h_0, dx, dy, h.dtype), *out,
+                    make_scratch(*h.shape, h.dtype))
+    return out
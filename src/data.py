@@ -7,11 +7,20 @@ import utils
 import core
 from config import OUTPUT_FOLDER
 
+try:
+    import dask
+    import dask.array as da
+except ModuleNotFoundError:
+    dask = None
+
+# Number of timesteps per dask chunk (for potential vorticity computation and output writing)
+DASK_CHUNK = 32
+
 
 
 class Data():
     """Store u, v and h over time"""
-    def __init__(self, x_list, y_list, output_dt):
+    def __init__(self, x_list, y_list, output_dt, capacity=100):
         self.x_list = x_list
         self.y_list = y_list
         self.output_dt = output_dt
@@ -20,58 +29,119 @@ class Data():
         self.ny = y_list.size - 1
         self.time = 0
 
-        self.make_dataset()
-
-    def make_dataset(self):
-        """Create dataset of u, v, h"""
-        u = xr.DataArray(np.full((1, self.ny, self.nx + 1), np.nan), dims=('time', 'y', 'x'))
-        v = xr.DataArray(np.full((1, self.ny + 1, self.nx), np.nan), dims=('time', 'y', 'x'))
-        h = xr.DataArray(np.full((1, self.ny, self.nx), np.nan), dims=('time', 'y', 'x'))
-        self.u = u.assign_coords(x=self.x_list, y=self.y_list[:-1], time=[0])
-        self.v = v.assign_coords(x=self.x_list[:-1], y=self.y_list, time=[0])
-        self.h = h.assign_coords(x=self.x_list[:-1], y=self.y_list[:-1], time=[0])
-        self.pv = self.h.copy()
-
-    def extend_dataset(self, n=100):
-        """Extend dataset allocation (double the size or add n if size < n).
-        This allows to indefinitely extend storage and thus simulation time while keeping a negligible
-        amount of array extensions (which is costly due to reallocation)."""
-        t_max = self.u.time.max()
-        n = max(n, self.u.time.size)
-        t_list = np.arange(t_max + self.output_dt, t_max + (n+1)*self.output_dt, self.output_dt)
-        new_u = np.full((n, self.ny, self.nx + 1), np.nan)
-        new_v = np.full((n, self.ny + 1, self.nx), np.nan)
-        new_h = np.full((n, self.ny, self.nx), np.nan)
-        new_u = xr.DataArray(new_u, dims=('time', 'y', 'x')).assign_coords(x=self.x_list, y=self.y_list[:-1], time=t_list)
-        new_v = xr.DataArray(new_v, dims=('time', 'y', 'x')).assign_coords(x=self.x_list[:-1], y=self.y_list, time=t_list)
-        new_h = xr.DataArray(new_h, dims=('time', 'y', 'x')).assign_coords(x=self.x_list[:-1], y=self.y_list[:-1], time=t_list)
-        self.u = xr.concat([self.u, new_u], dim='time')
-        self.v = xr.concat([self.v, new_v], dim='time')
-        self.h = xr.concat([self.h, new_h], dim='time')
-        self.pv = xr.concat([self.pv, new_h.copy()], dim='time')
-        utils.log(f'Dataset extension by {n} (total size of {self.u.time.size} timesteps).')
-    
+        self.make_buffers(capacity)
+
+    def make_buffers(self, capacity):
+        """Start an empty storage of u, v, h, pv made of chunks of `capacity` timesteps"""
+        self._chunk_size = capacity
+        self._chunks = []
+        self._n = 0  # Number of stored timesteps (index of the last one + 1)
+        self._arrays = {}  # DataArrays of the concatenated chunks, until the next write
+
+    def _new_chunk(self, k_0, n):
+        """Allocate empty storage of time, u, v, h, pv for n timesteps starting at output index k_0"""
+        return {
+            'time': (k_0 + np.arange(n, dtype=np.int64)) * self.output_dt,
+            'u': np.full((n, self.ny, self.nx + 1), np.nan, dtype=utils.DTYPE),
+            'v': np.full((n, self.ny + 1, self.nx), np.nan, dtype=utils.DTYPE),
+            'h': np.full((n, self.ny, self.nx), np.nan, dtype=utils.DTYPE),
+            'pv': np.full((n, self.ny, self.nx), np.nan, dtype=utils.DTYPE),
+        }
+
+    def _grow(self):
+        """Extend storage allocation by a new chunk.
+        Filled chunks are kept as they are, so extending the storage never copies stored timesteps."""
+        self._chunks.append(self._new_chunk(self._capacity, self._chunk_size))
+        if len(self._chunks) > 1:
+            utils.log('Dataset extension by %d (total size of %d timesteps).', self._chunk_size, self._capacity)
+
+    @property
+    def _capacity(self):
+        """Number of allocated timesteps"""
+        return len(self._chunks) * self._chunk_size
+
+    def _filled_chunks(self):
+        """Iterate over the filled part of each chunk"""
+        for c, chunk in enumerate(self._chunks):
+            n = self._n - c * self._chunk_size
+            if n <= 0:
+                break
+            yield {var: buf[:n] for var, buf in chunk.items()}
+
+    def _stored(self, var):
+        """Concatenate the stored timesteps of a variable (empty if nothing is stored yet)"""
+        return np.concatenate([self._new_chunk(0, 0)[var]] + [chunk[var] for chunk in self._filled_chunks()])
+
+    def _to_dataarray(self, var, x, y):
+        """Wrap the stored timesteps of a variable in a DataArray
+        The chunks are concatenated on the first access only, until the next write."""
+        if var not in self._arrays:
+            self._arrays[var] = xr.DataArray(self._stored(var), dims=('time', 'y', 'x'),
+                                             coords={'x': x, 'y': y, 'time': self._stored('time')})
+        return self._arrays[var]
+
+    @property
+    def u(self):
+        return self._to_dataarray('u', self.x_list, self.y_list[:-1])
+
+    @property
+    def v(self):
+        return self._to_dataarray('v', self.x_list[:-1], self.y_list)
+
+    @property
+    def h(self):
+        return self._to_dataarray('h', self.x_list[:-1], self.y_list[:-1])
+
+    @property
+    def pv(self):
+        return self._to_dataarray('pv', self.x_list[:-1], self.y_list[:-1])
+
+    def _write(self, k, time, u, v, h, pv=None):
+        """Write a timestep at output index k (extending storage if needed)"""
+        while k >= self._capacity:
+            self._grow()
+        chunk = self._chunks[k // self._chunk_size]
+        i = k % self._chunk_size
+        chunk['time'][i] = time
+        chunk['u'][i] = u
+        chunk['v'][i] = v
+        chunk['h'][i] = h
+        if pv is not None:
+            chunk['pv'][i] = pv
+        self._n = max(self._n, k + 1)
+        self.time = max(self.time, time)
+        self._arrays.clear()
+
     def store_state(self, time, u, v, h, pv=None):
-        """Store current state of simulation"""
-        try:
-            d = dict(time=time)
-            self.u.loc[d] = u
-            self.v.loc[d] = v
-            self.h.loc[d] = h
-            if pv is not None:
-                self.pv.loc[d] = pv
-            self.time = max(self.time, time)
-        except KeyError:
-            self.extend_dataset()
-            self.store_state(time, u, v, h, pv)
-
-    def save_nc(self, attrs={}, filename='', folder=OUTPUT_FOLDER, save_pv=True):
-        """Save output as NETCDF file."""
+        """Store current state of simulation
+        The output index is given by the time, so that storing a time again overwrites it."""
+        self._write(round(time / self.output_dt), time, u, v, h, pv)
+
+    def load_dataset(self, ds):
+        """Load u, v, h (and pv if available) from a dataset created with `to_dataset`."""
+        self.make_buffers(self._chunk_size)
+        self.time = 0
+        # Variables of the dataset share the same x, y coordinates which are cropped to their own grid
+        u = ds.u.values[:, :-1, :]
+        v = ds.v.values[:, :, :-1]
+        h = ds.h.values[:, :-1, :-1]
+        pv = ds.pv.values[:, :-1, :-1] if 'pv' in ds.variables else [None] * h.shape[0]
+        for k, time in enumerate(ds.time.values):
+            self._write(k, time, u[k], v[k], h[k], pv[k])
+
+    def save_nc(self, attrs={}, filename='', folder=OUTPUT_FOLDER, save_pv=True, n_workers=None):
+        """Save output as NETCDF file.
+        With dask, the dataset is written by chunks of timesteps using `n_workers` threads (all cores by default)."""
         ds = self.to_dataset(attrs=attrs, save_pv=save_pv)
         if filename == '':
             filename = utils.generate_output_name('output')
         folder = utils.check_path(folder)
-        ds.to_netcdf(folder / f'{filename.removesuffix(".nc")}.nc')
+        path = folder / f'{filename.removesuffix(".nc")}.nc'
+        if dask is None:
+            ds.to_netcdf(path)
+        else:
+            with dask.config.set(scheduler='threads', num_workers=n_workers):
+                ds.chunk({'time': DASK_CHUNK}).to_netcdf(path)
 
     def to_dataset(self, attrs, save_pv=True):
         ds = xr.Dataset({'u': self.u, 'v': self.v, 'h': self.h})
@@ -110,13 +180,34 @@ class Data():
             ds['pv'] = self.pv
             ds['pv'].attrs |= pv_attrs
         ds.attrs |= attrs
-        return ds.sel(time=ds.time <= self.time)
+        return ds
     
-    def compute_pv(self, h_0, f):
-        """Compute potential vorticity"""
+    def compute_pv(self, h_0, f, n_workers=None):
+        """Compute potential vorticity.
+        With dask, timesteps are processed by chunks using `n_workers` threads (all cores by default)."""
         utils.log('Computing potential vorticity...')
         dx, dy = self.x_list[1] - self.x_list[0], self.y_list[1] - self.y_list[0]
-        pv = np.array([core.pv(u.values, v.values, h.values + h_0, f, dx, dy) for (u, h, v) in zip(self.u, self.h, self.v)])
-        pv = xr.DataArray(pv, dims=('time', 'y', 'x')).assign_coords(x=self.x_list[:-1], y=self.y_list[:-1], time=self.h.time)
-        self.pv = pv
-        return pv
+        chunks = [chunk for chunk in self._filled_chunks() if chunk['time'].size > 0]
+        if dask is None:
+            for chunk in chunks:
+                chunk['pv'][:] = _pv_block(chunk['u'], chunk['v'], chunk['h'], h_0, f, dx, dy)
+        else:
+            sources = [
+                da.map_blocks(_pv_block, *(da.from_array(chunk[var], chunks=(DASK_CHUNK, -1, -1)) for var in 'uvh'),
+                              h_0=h_0, f=f, dx=dx, dy=dy, dtype=chunk['pv'].dtype)
+                for chunk in chunks
+            ]
+            # Chunks are written in distinct parts of the storage
+            da.store(sources, [chunk['pv'] for chunk in chunks], lock=False,
+                     scheduler='threads', num_workers=n_workers)
+        self._arrays.pop('pv', None)
+        return self.pv
+
+
+def _pv_block(u, v, h, h_0, f, dx, dy):
+    """Compute potential vorticity of a block of timesteps"""
+    pv = np.empty_like(h)
+    h_tot = np.empty_like(h[0])  # Total thickness, reused for all timesteps
+    for k in range(h.shape[0]):
+        pv[k] = core.pv(u[k], v[k], np.add(h[k], h_0, out=h_tot), f, dx, dy)
+    return pv
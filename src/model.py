@@ -1,5 +1,7 @@
 """Rotating shallow water model centered on the pole"""
 
+from functools import partial
+
 import numpy as np
 import xarray as xr
 from scipy.special import gammaincc, gamma
@@ -9,6 +11,16 @@ from data import Data
 import utils
 import core
 
+try:
+    import core_numba
+except ModuleNotFoundError:
+    core_numba = None
+
+try:
+    import core_cupy
+except ModuleNotFoundError:
+    core_cupy = None
+
 DEFAULT_PARAMS = {
     'lat_min': LAT_MIN,
     'lat_sponge': LAT_SPONGE,
@@ -24,11 +36,13 @@ DEFAULT_PARAMS = {
 }
 
 
-def h_vort(r, h_0, r_m, ro, bu, b):
-    """Return a vortex h at a distance r from the center"""
+def h_vort(r, h_0, r_m, ro, bu, b, gamma_s=None):
+    """Return a vortex h at a distance r from the center (`gamma_s` is gamma(2/b), computed if not given)"""
     x_ = 1/b * (r/r_m)**b
     s_ = 2/b
-    gam = gamma(s_) * gammaincc(s_, x_)
+    if gamma_s is None:
+        gamma_s = gamma(s_)
+    gam = gamma_s * gammaincc(s_, x_)
     return + h_0 * (ro/bu * np.exp(1/b) * np.exp(2/b - 1) * gam)
 
 
@@ -37,19 +51,24 @@ def v_vort(r, v_m, r_m, b):
     return - v_m * r/r_m * np.exp(1/b * (1 - (r/r_m)**b))
 
 
-def ini_point(x, y, vort_centers, r_m, v_m, b, h_0, ro, bu):
-    '''Return initial u, v, h at given point'''
+def ini_point(x, y, vort_centers, r_m, v_m, b, h_0, ro, bu, gamma_s=None):
+    '''Return initial u, v, h at given points (x and y can be arrays)'''
     h = 0
     u = 0
     v = 0
+    if gamma_s is None:
+        gamma_s = gamma(2/b)
     for x0, y0 in vort_centers:
-        r_ = utils.r(x - x0, y - y0)
-        h += h_vort(r_, h_0, r_m, ro, bu, b)
-        if r_ < 1e-12:
-            continue
-        v_az = v_vort(r_, v_m, r_m, b)
-        u -= v_az * (y-y0) / r_
-        v += v_az * (x-x0) / r_
+        dx_ = x - x0
+        dy_ = y - y0
+        r2 = dx_ * dx_ + dy_ * dy_
+        r_ = np.sqrt(r2)
+        h += h_vort(r_, h_0, r_m, ro, bu, b, gamma_s)
+        # Inverse distance, set to 0 at the vortex center (where the velocity is null)
+        inv_r = np.divide(1, r_, out=np.zeros_like(r_), where=r2 >= 1e-24)
+        v_az = v_vort(r_, v_m, r_m, b) * inv_r
+        u -= v_az * dy_
+        v += v_az * dx_
     return u, v, h
 
 
@@ -63,8 +82,9 @@ def make_vort_centers(vort_lat, vort_number, r_max, lat_min):
         vort_lat = [vort_lat]
         vort_number = [vort_number]
     centers = []
+    r_scale = r_max / utils.co(lat_min)  # Distance to the pole per degree of colatitude
     for lat, number in zip(vort_lat, vort_number):
-        r_ = utils.co(lat) / utils.co(lat_min) * r_max
+        r_ = utils.co(lat) * r_scale
         angle_step = 2 * np.pi / number 
         for k in range(number):
             centers.append((r_ * np.cos(k*angle_step), r_ * np.sin(k*angle_step)))
@@ -79,8 +99,9 @@ def make_vort_centers_from_coords(vort_coords, r_max, lat_min):
     except TypeError:
         vort_coords = [vort_coords]
     centers = []
+    r_scale = r_max / utils.co(lat_min)  # Distance to the pole per degree of colatitude
     for lat, lon in vort_coords:
-        r_ = utils.co(lat) / utils.co(lat_min) * r_max
+        r_ = utils.co(lat) * r_scale
         centers.append((r_ * np.cos(lon * np.pi / 180), r_ * np.sin(lon * np.pi / 180)))
     return centers
     
@@ -91,11 +112,25 @@ class Model():
     def __init__(self, nx, ny=None, 
                  lat_min=LAT_MIN, lat_sponge=LAT_SPONGE,
                  r_planet=R, t_planet=T, g=G,
-                 ro=RO, bu=BU, b=B, r_m=R_M, cfl=CFL, output_dt=OUTPUT_TIMESTEP):
+                 ro=RO, bu=BU, b=B, r_m=R_M, cfl=CFL, output_dt=OUTPUT_TIMESTEP, backend=BACKEND):
         self.nx = nx
         self.ny = ny if ny is not None else nx
         self.timestep = 0
 
+        # Array module on which the simulation runs
+        if backend == 'numpy':
+            self.xp = np
+            # With Numba, steps are computed by `core_numba.rk3_kernel_into` (see below)
+            self._rk3 = core.rk3 if core_numba is None else None
+        elif backend == 'cupy':
+            if core_cupy is None:
+                raise ModuleNotFoundError('CuPy is required to use the \'cupy\' backend.')
+            self.xp = core_cupy.cp
+            self._rk3 = core_cupy.rk3
+        else:
+            raise ValueError('Backend should be \'numpy\' or \'cupy\'.')
+        self.backend = backend
+
         self.lat_min = lat_min
         self.lat_sponge = lat_sponge
 
@@ -106,6 +141,7 @@ class Model():
         self.bu = bu
         self.ro = ro
         self.b = b
+        self._gamma_s = gamma(2/b)
         self.r_m = r_m
         self.g = g
         self.r_planet = r_planet
@@ -124,23 +160,61 @@ class Model():
         self.output_nt = max(int(output_dt / self.dt), 1)
 
         # Coordinates
-        self.x_list = np.linspace(-self.r_max, self.r_max + self.dx, self.nx + 1)
-        self.y_list = np.linspace(-self.r_max, self.r_max + self.dy, self.ny + 1)
-        self.x, self.y = np.meshgrid(self.x_list, self.y_list)
+        self.x_list = np.linspace(-self.r_max, self.r_max + self.dx, self.nx + 1, dtype=utils.DTYPE)
+        self.y_list = np.linspace(-self.r_max, self.r_max + self.dy, self.ny + 1, dtype=utils.DTYPE)
+        # Broadcastable (1, nx + 1) and (ny + 1, 1) views, the full grids are only built by the computations
+        self.x, self.y = np.meshgrid(self.x_list, self.y_list, sparse=True)
         self.r = utils.r(self.x, self.y)
         self.colat = utils.colat(self.x, self.y, self.lat_min, self.r_max)
 
+        # Simulation arrays are C-contiguous and aligned (CuPy allocations are already aligned to 256 bytes)
+        if self.backend == 'numpy':
+            zeros, asarray = utils.zeros_aligned, utils.asarray_aligned
+        else:
+            zeros = self.xp.zeros
+            asarray = lambda a, dtype: self.xp.ascontiguousarray(self.xp.asarray(a, dtype=dtype))
+
         # Prognostic variables
-        self.u = np.zeros((self.ny, self.nx + 1))
-        self.v = np.zeros((self.ny + 1, self.nx))
-        self.h = np.zeros((self.ny, self.nx))
+        self.u = zeros((self.ny, self.nx + 1), dtype=utils.DTYPE)
+        self.v = zeros((self.ny + 1, self.nx), dtype=utils.DTYPE)
+        self.h = zeros((self.ny, self.nx), dtype=utils.DTYPE)
 
         # Coriolis parameter
-        self.f = self.f_0 * np.cos(np.pi * self.colat / 180)
+        self.f = asarray(self.f_0 * np.cos(np.pi * self.colat / 180), dtype=utils.DTYPE)
 
         # Sponge coefficient
-        self.sponge = np.maximum((utils.co(self.lat_min) - np.maximum(self.colat, utils.co(self.lat_sponge)))
-                                 / (utils.co(self.lat_min) - utils.co(self.lat_sponge)), 0)
+        co_min, co_sponge = utils.co(self.lat_min), utils.co(self.lat_sponge)
+        sponge = np.maximum(self.colat, co_sponge)
+        np.subtract(co_min, sponge, out=sponge)
+        sponge /= co_min - co_sponge
+        self.sponge = asarray(np.maximum(sponge, 0, out=sponge), dtype=utils.DTYPE)
+        # Contiguous sponge coefficients on the u and v grids
+        self.sponge_u = asarray(self.sponge[:-1, :], dtype=utils.DTYPE)
+        self.sponge_v = asarray(self.sponge[:, :-1], dtype=utils.DTYPE)
+        # Sponge given to the time stepping
+        self._damp_u = self.sponge_u
+        self._damp_v = self.sponge_v
+
+        # Temporary arrays of the NumPy time stepping (the compiled kernels manage their own)
+        # and band of damped points, out of which the sponge coefficient is 1
+        if self._rk3 is core.rk3:
+            self._scratch = core.make_scratch(self.ny, self.nx, utils.DTYPE)
+            self._rk3 = partial(core.rk3, scratch=self._scratch)
+            self._damp_u = core.sponge_band(self.sponge_u)
+            self._damp_v = core.sponge_band(self.sponge_v)
+
+        # Numba kernel stepping from one set of buffers to the other,
+        # with the RK3 stages blocked per tile only if the state does not fit in cache
+        self._rk3_into = None
+        if self.backend == 'numpy' and core_numba is not None:
+            state_bytes = (self.h.size + self.u.size + self.v.size) * self.h.itemsize
+            if state_bytes > core_numba.BLOCKED_MIN_BYTES:
+                self._rk3_into = core_numba.rk3_blocked_into
+            else:
+                self._rk3_into = partial(core_numba.rk3_kernel_into,
+                                         scratch=core_numba.make_scratch(self.ny, self.nx, utils.DTYPE))
+            self._next = tuple(utils.empty_aligned(a.shape, utils.DTYPE) for a in (self.h, self.u, self.v))
+            self._rk3_constants = core_numba.rk3_constants(self.dt, self.g, self.h_0, self.dx, self.dy, utils.DTYPE)
         
         # Storage
         self.data = Data(self.x_list, self.y_list, self.output_nt * self.dt)
@@ -158,7 +232,7 @@ class Model():
             'output_dt': self.output_dt
         }
         
-        utils.log(f'Configuration successfully created. Timestep: dt = {self.dt} s')
+        utils.log('Configuration successfully created. Timestep: dt = %d s', self.dt)
 
     def initialize(self, vort_lat=None, vort_number=None, vort_coords=None):
         """Set initial conditions.
@@ -173,30 +247,48 @@ class Model():
             centers += make_vort_centers_from_coords(vort_coords, self.r_max, self.lat_min)
 
         # Initialize u, v and h
-        for i in range(self.nx):
-            for j in range(self.ny):
-                self.u[j, i], self.v[j, i], self.h[j, i] = ini_point(
-                    self.x[j, i], self.y[j, i], 
-                    vort_centers=centers,
-                    r_m=self.r_m, v_m=self.v_m, b=self.b, h_0=self.h_0, ro=self.ro, bu=self.bu 
-                )
+        u, v, h = ini_point(
+            self.x[:self.ny, :self.nx], self.y[:self.ny, :self.nx],
+            vort_centers=centers,
+            r_m=self.r_m, v_m=self.v_m, b=self.b, h_0=self.h_0, ro=self.ro, bu=self.bu,
+            gamma_s=self._gamma_s
+        )
+        self.u[:, :self.nx] = self.xp.asarray(u)
+        self.v[:self.ny, :] = self.xp.asarray(v)
+        self.h[:, :] = self.xp.asarray(h)
 
         # Initialize dataset (for storing the evolution of the system)
-        self.data.store_state(0, self.u, self.v, self.h, 
-                              core.pv(self.u, self.v, self.h + self.h_0, self.f, self.dx, self.dy))
+        self.store_state(0)
+
+    def asnumpy(self, a):
+        """Return array `a` in host memory (no copy with the numpy backend)."""
+        return core_cupy.cp.asnumpy(a) if self.backend == 'cupy' else a
+
+    def store_state(self, time):
+        """Store current state of simulation (and its potential vorticity) in host memory."""
+        pv = core.pv(self.u, self.v, self.h + self.h_0, self.f, self.dx, self.dy)
+        self.data.store_state(time, *(self.asnumpy(a) for a in (self.u, self.v, self.h, pv)))
 
     def step(self):
         """Run one step of the simulation"""
-        h, u, v = core.rk3(self.h, self.u, self.v,
-                           dt=self.dt, f=self.f, g=self.g, h_0=self.h_0,
-                           dx=self.dx, dy=self.dy)
-        self.h = h
-        self.u = u * self.sponge[:-1, :]
-        self.v = v * self.sponge[:, :-1]
+        # Scalars are cast so that they do not promote the arrays to double precision
+        real = utils.DTYPE
+        if self._rk3_into is not None:
+            self._rk3_into(self.h, self.u, self.v, self.f, self.sponge_u, self.sponge_v,
+                           *self._rk3_constants, *self._next)
+            # The buffers of the previous state receive the next one
+            (self.h, self.u, self.v), self._next = self._next, (self.h, self.u, self.v)
+        else:
+            h, u, v = self._rk3(self.h, self.u, self.v,
+                                dt=real(self.dt), f=self.f, g=real(self.g), h_0=real(self.h_0),
+                                dx=real(self.dx), dy=real(self.dy), sponge_u=self._damp_u, sponge_v=self._damp_v)
+            self.h = h
+            self.u = u
+            self.v = v
+        assert self.h.dtype == self.u.dtype == self.v.dtype == real, 'Precision of the simulation arrays changed.'
         self.timestep += 1
         if self.timestep % self.output_nt == 0:
-            self.data.store_state(self.timestep * self.dt, self.u, self.v, self.h,
-                                  core.pv(self.u, self.v, self.h + self.h_0, self.f, self.dx, self.dy))
+            self.store_state(self.timestep * self.dt)
 
     def run(self, time):
         """Run simulation for given time.
@@ -206,11 +298,11 @@ class Model():
         step_init = self.timestep
         while self.timestep * self.dt - t_0 < time:
             self.step()
-        utils.log(f'Successfully ran the simulation for {self.timestep - step_init} timesteps ({utils.sec_to_str(time)}).')
+        utils.log('Successfully ran the simulation for %d timesteps (%s).', self.timestep - step_init, utils.sec_to_str(time))
 
-    def save_nc(self, filename='', folder=OUTPUT_FOLDER, save_pv=True):
+    def save_nc(self, filename='', folder=OUTPUT_FOLDER, save_pv=True, n_workers=None):
         """Save output as NETCDF file."""
-        self.data.save_nc(filename=filename, folder=folder, attrs=self.attrs, save_pv=True)
+        self.data.save_nc(filename=filename, folder=folder, attrs=self.attrs, save_pv=True, n_workers=n_workers)
 
     def to_dataset(self):
         return self.data.to_dataset(attrs=self.attrs)
@@ -224,18 +316,13 @@ def open_dataset(path, **params):
     ny = ds.y.size - 1
     params = DEFAULT_PARAMS | ds.attrs | params
     m = Model(nx, ny, **params)
-    m.data.h = ds.h[:, :-1, :-1]
-    m.data.u = ds.u[:, :-1, :]
-    m.data.v = ds.v[:, :, :-1]
-    m.data.time = ds.time.max()
-
-    if 'pv' in ds.variables:
-        m.data.pv = ds.pv[:, :-1, :-1]
-    else:
-        m.data.compute_pv(m.h_0, m.f)
+    m.data.load_dataset(ds)
+    if 'pv' not in ds.variables:
+        m.data.compute_pv(m.h_0, m.asnumpy(m.f))
 
     m.timestep = int(ds.time.max() / m.dt)
-    m.h = m.data.h.sel(time=m.data.time).values
-    m.u = m.data.u.sel(time=m.data.time).values
-    m.v = m.data.v.sel(time=m.data.time).values
+    # The last state is copied in the (aligned) arrays of the model
+    m.h[...] = m.xp.asarray(m.data.h.sel(time=m.data.time).values)
+    m.u[...] = m.xp.asarray(m.data.u.sel(time=m.data.time).values)
+    m.v[...] = m.xp.asarray(m.data.v.sel(time=m.data.time).values)
     return m
\ No newline at end of file
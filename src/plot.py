@@ -19,6 +19,11 @@ try:
 except ModuleNotFoundError:
     DEFAULT_CMAP = plt.get_cmap('viridis')
 
+try:
+    from numba import njit
+except ModuleNotFoundError:
+    njit = None
+
 units = {
     'u': '[$m.s^{-1}$]',
     'v': '[$m.s^{-1}$]',
@@ -35,9 +40,31 @@ def fmt(x):
     return rf"{s} °"
 
 
+def _nan_minmax(a):
+    """Return min and max of array a ignoring NaNs."""
+    return np.nanmin(a), np.nanmax(a)
+
+
+if njit is not None:
+    @njit(cache=True, nogil=True)
+    def _nan_minmax_kernel(flat):
+        """Single pass min and max (comparisons with NaN are false so they are skipped)."""
+        lo, hi = np.inf, -np.inf
+        for x in flat:
+            if x < lo:
+                lo = x
+            if x > hi:
+                hi = x
+        return lo, hi
+
+    def _nan_minmax(a):
+        """Return min and max of array a ignoring NaNs."""
+        return _nan_minmax_kernel(np.ascontiguousarray(a).ravel())
+
+
 def show_var(model, var, cmap=DEFAULT_CMAP, title=None, show_lat=False):
     """Plot a variable of the current state of the simulation."""
-    mat = getattr(model, var)[:model.ny, :model.nx]
+    mat = model.asnumpy(getattr(model, var))[:model.ny, :model.nx]
     fig, ax = plt.subplots()
     pcol = ax.pcolormesh(model.x_list[:-1], model.y_list[:-1], mat, cmap=cmap)
     if show_lat:
@@ -54,8 +81,8 @@ def show_var_anim(model, var, n_frames=None, cmap=DEFAULT_CMAP, title=None, pola
                   save_as=None, filename='', folder=OUTPUT_FOLDER, save_dpi=200, fps=24):
     data = getattr(model.data, var)
     data = data.sel(time=data.time <= model.timestep * model.dt)
-    v_max = np.max(data)
-    v_min = np.min(data)
+    arr = data.values
+    v_min, v_max = _nan_minmax(arr)
     n = data.shape[0]
     if n_frames is None:
         n_frames = n
@@ -81,13 +108,19 @@ def show_var_anim(model, var, n_frames=None, cmap=DEFAULT_CMAP, title=None, pola
         ax.clabel(cs, cs.levels, inline=True, fontsize=8)
         ax.axis('off')
     
-    # Update plot
+    # Update plot (only the mesh and the time label are redrawn)
+    # The label is inside the axes since blitting only redraws the axes area
+    times = data.time.values
+    label = ax.text(0.5, 0.97, '', transform=ax.transAxes, ha='center', va='top',
+                    bbox={'facecolor': 'white', 'alpha': 0.7, 'edgecolor': 'none'})
+
     def update(frame):
         k = int(frame * n / n_frames)
-        pcol.set_array(data[k].values.ravel())
-        ax.set_title(f't = {data.time[k] / 86400 :.0f} d')
+        pcol.set_array(arr[k].ravel())
+        label.set_text(f't = {times[k] / 86400 :.0f} d')
+        return pcol, label
 
-    anim = FuncAnimation(fig, update, frames=n_frames, interval=200)
+    anim = FuncAnimation(fig, update, frames=n_frames, interval=200, blit=True, cache_frame_data=False)
 
     # Save
     if filename == '':
@@ -96,7 +129,8 @@ def show_var_anim(model, var, n_frames=None, cmap=DEFAULT_CMAP, title=None, pola
         ffwriter = FFMpegWriter()
         try:
             folder = utils.check_path(folder)
-            anim.save(folder / (filename.removesuffix('.mp4')+'.mp4'), writer=ffwriter, dpi=save_dpi)
+            anim.save(folder / (filename.removesuffix('.mp4')+'.mp4'), writer=ffwriter, dpi=save_dpi,
+                      savefig_kwargs={'facecolor': 'white'})
         except (PermissionError, FileNotFoundError):
             utils.warn('Could not save as MP4, check that ffmpeg executable is at the path specified in the configuration file.')
     elif save_as in ('gif', 'GIF'):
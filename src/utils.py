@@ -1,15 +1,85 @@
 """Utility functions"""
 
 import numpy as np
-from datetime import datetime, timedelta
-import re
+import math
+import os
+import time
+from fractions import Fraction
+from functools import lru_cache, reduce
 from pathlib import Path
 
 from config import LOG
 
+try:
+    from numba import vectorize
+except ModuleNotFoundError:
+    vectorize = None
+
+# Floating point precision of the simulation arrays
+DTYPE = np.float32
+# Alignment in bytes of the simulation arrays (width of AVX-512 registers and of a cache line)
+ALIGNMENT = 64
+
+
+def empty_aligned(shape, dtype=DTYPE, align=ALIGNMENT):
+    """Return an empty C-contiguous array whose data starts at a multiple of `align` bytes."""
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape)) * dtype.itemsize
+    buf = np.empty(size + align, dtype=np.uint8)
+    offset = -buf.ctypes.data % align
+    return buf[offset:offset + size].view(dtype).reshape(shape)
+
+
+def zeros_aligned(shape, dtype=DTYPE, align=ALIGNMENT):
+    """Return an array of zeros allocated with `empty_aligned`."""
+    a = empty_aligned(shape, dtype, align)
+    a[...] = 0
+    return a
+
+
+def asarray_aligned(a, dtype=DTYPE, align=ALIGNMENT):
+    """Return a copy of `a` allocated with `empty_aligned`."""
+    out = empty_aligned(np.shape(a), dtype, align)
+    out[...] = a
+    return out
+
+
+if vectorize is not None:
+    @vectorize(['f4(f4, f4, f4)', 'f8(f8, f8, f8)'], fastmath=True, cache=True)
+    def _hypot_ufunc(x, y, scale):
+        """Compute hypot(x, y) * scale (elementwise, with NumPy broadcasting)."""
+        return math.hypot(x, y) * scale
+
+
+def _ensure_soa(a, dtype=DTYPE):
+    """Return `a` as a C-contiguous array of dtype (copied only if a is not), so that ufuncs read it
+    with unit stride and as many SIMD lanes as possible.
+    Coordinates of points should be given as separate x and y arrays rather than as a (n, 2) array."""
+    return np.ascontiguousarray(a, dtype=dtype) if np.ndim(a) > 0 else np.dtype(dtype).type(a)
+
+
+def _hypot(x, y, scale=None):
+    """Return hypot(x, y) (multiplied by scale if given), with a Numba ufunc on arrays if available."""
+    if np.isscalar(x) and np.isscalar(y):
+        d = math.hypot(x, y)
+    elif vectorize is not None:
+        return _hypot_ufunc(_ensure_soa(x), _ensure_soa(y), 1 if scale is None else scale)
+    else:
+        d = np.hypot(_ensure_soa(x), _ensure_soa(y))
+    return d if scale is None else d * scale
+
+
 def r(x, y):
     """Calculate distance of (x, y) to (0, 0)."""
-    return np.sqrt(x**2 + y**2)
+    return _hypot(x, y)
+
+
+def r_nd(*coords):
+    """Calculate distance of a point of any number of coordinates to the origin."""
+    if len(coords) == 2:
+        return r(*coords)
+    # Folded over `_hypot` so that the result has the same precision as with 2 coordinates
+    return reduce(_hypot, coords, 0)
 
 
 def co(lat):
@@ -17,55 +87,155 @@ def co(lat):
     return 90 - lat
 
 
+def co_inplace(a, out=None):
+    """Calculate colatitude from latitude or latitude from colatitude of array a, in `out` (a by default)."""
+    return np.subtract(90, a, out=a if out is None else out)
+
+
 def colat(x, y, lat_min, r_max):
     '''Return colatitude of given x, y point'''
-    return r(x, y) * co(lat_min) / r_max
+    return _hypot(x, y, co(lat_min) / r_max)
+
+
+def colat_into(x, y, lat_min, r_max, out):
+    '''Compute colatitude of given x, y points in the preallocated array `out` (in the precision of `out`)'''
+    scale = co(lat_min) / r_max
+    x, y = _ensure_soa(x, out.dtype), _ensure_soa(y, out.dtype)
+    if vectorize is not None:
+        return _hypot_ufunc(x, y, scale, out=out)
+    np.hypot(x, y, out=out)
+    out *= scale
+    return out
+
+
+def make_colat(lat_min, r_max):
+    '''Return a function (x, y) -> colatitude for the given lat_min and r_max'''
+    scale = co(lat_min) / r_max
+
+    def colat_(x, y):
+        return _hypot(x, y, scale)
+    return colat_
+
+
+# Prefix of log lines, formatted once per second
+_last_sec = None
+_last_prefix = ''
 
 
-def log(text):
-    if not LOG:
-        return
-    print(f'[{datetime.now().strftime(r"%H:%M:%S")}] {text}')
+# LOG is fixed by the configuration, so log and warn are bound once to a printing function or to a no-op
+if LOG:
+    def log(fmt, *args):
+        """Print a timestamped message (`fmt % args` if arguments are given)."""
+        global _last_sec, _last_prefix
+        sec = int(time.time())
+        if sec != _last_sec:
+            _last_prefix = time.strftime('[%H:%M:%S] ', time.localtime(sec))
+            _last_sec = sec
+        print(f'{_last_prefix}{fmt % args if args else fmt}')
 
+    def warn(fmt, *args):
+        log('WARNING | ' + fmt, *args)
+else:
+    def log(fmt, *args):
+        """Logging is disabled in the configuration."""
 
-def warn(text):
-    log('WARNING | ' + text)
+    def warn(fmt, *args):
+        """Logging is disabled in the configuration."""
+
+
+# Units of `parse_time` (None is the ambiguous month or minute), sorted longest first so that
+# e.g. 'MIN' is not read as 'M' followed by 'IN'
+_TIME_UNITS = sorted({
+    'Y': 'y', 'YR': 'y', 'YRS': 'y', 'YEAR': 'y', 'YEARS': 'y',
+    'M': None, 'MONTH': 'm', 'MONTHS': 'm',
+    'W': 'w', 'WEEK': 'w', 'WEEKS': 'w',
+    'D': 'd', 'DAY': 'd', 'DAYS': 'd',
+    'H': 'h', 'HR': 'h', 'HRS': 'h', 'HOUR': 'h', 'HOURS': 'h',
+    'MIN': 'min', 'MINUTE': 'min', 'MINUTES': 'min',
+    'S': 's', 'SEC': 's', 'SECOND': 's', 'SECONDS': 's',
+}.items(), key=lambda unit: -len(unit[0]))
+_TIME_SECONDS = {'y': 365 * 86400, 'm': 30 * 86400, 'w': 7 * 86400, 'd': 86400, 'h': 3600, 'min': 60, 's': 1}
 
 
 def parse_time(val):
     """Parse `val` into a duration in seconds.
-    `val` can be a number or a string such as `'1y2m3d6h3m5s'`.
-    Note that `'m'` is ambiguous between month and minute and will be interpreted depending on position (month by default)."""
+    `val` can be a number or a string such as `'1y2m3d6h3m5s'` (numbers can be decimal, e.g. `'1.5d'`).
+    Note that `'m'` is ambiguous between month and minute and will be interpreted depending on position
+    (month by default, minute after a month, week, day or hour)."""
     if isinstance(val, (float, int)):
         return val
     if not isinstance(val, str):
         raise ValueError('Time should be a number or a string.')
-    regex = re.compile(r'((?P<y>\d+?)(Y|YR|YRS|YEARS|YEAR))?((?P<m>\d+?)(M|MONTHS|MONTH))?((?P<w>\d+?)(W|WEEKS|WEEK))?((?P<d>\d+?)D|DAY|DAYS)?((?P<h>\d+?)(H|HR|HRS|HOUR|HOURS))?((?P<min>\d+?)(M|MIN|MINUTE|MINUTES))?((?P<s>\d+?)(S|SEC|SECONDS|SECOND))?')
+    return _parse_time_str(val)
+
+
+@lru_cache(maxsize=256)
+def _parse_time_str(val):
+    """Parse a time string (see `parse_time`), results are cached."""
     val = val.replace(' ', '').upper()
-    time = regex.match(val).groupdict()
-    for key in time:
-        if time[key] is None:
-            time[key] = 0
+    secs = 0
+    seen = set()
+    i = 0
+    while i < len(val):
+        j = i
+        while j < len(val) and (val[j].isdigit() or val[j] == '.'):
+            j += 1
+        if j == i or val[i:j].count('.') > 1 or val[i:j] == '.':
+            raise ValueError(f'Invalid time string, expected a number at position {i} of \'{val}\'.')
+        for token, key in _TIME_UNITS:
+            if val.startswith(token, j):
+                break
         else:
-            time[key] = float(time[key])
-    secs = (((365 * time['y'] + 30 * time['m'] + 7 * time['w'] + time['d'])
-            * 24 + time['h']) * 60 + time['min']) * 60 + time['s']
-    return secs
+            raise ValueError(f'Invalid time string, expected a unit at position {j} of \'{val}\'.')
+        if key is None:
+            key = 'min' if seen & {'m', 'w', 'd', 'h'} else 'm'
+        seen.add(key)
+        # Decimal numbers are summed as exact fractions
+        number = val[i:j]
+        secs += (Fraction(number) if '.' in number else int(number)) * _TIME_SECONDS[key]
+        i = j + len(token)
+    # Integer seconds unless the decimal numbers give a fraction of second
+    return int(secs) if secs.denominator == 1 else float(secs)
 
 
 def sec_to_str(val):
-    """Return duration in seconds as a string."""
-    duration = timedelta(seconds=val)
-    return str(duration)
+    """Return duration in seconds as a string (formatted as a `timedelta`, e.g. `'1 day, 2:03:04'`)."""
+    if isinstance(val, int):
+        s, us = val, 0
+    else:
+        # Fractions of second are rounded to microseconds as by timedelta
+        frac, whole = math.modf(val)
+        s, us = divmod(int(whole) * 1_000_000 + round(frac * 1e6), 1_000_000)
+    m, s = divmod(s, 60)
+    h, m = divmod(m, 60)
+    d, h = divmod(h, 24)
+    text = f'{h}:{m:02d}:{s:02d}' if us == 0 else f'{h}:{m:02d}:{s:02d}.{us:06d}'
+    if d:
+        text = f'{d} day{"" if abs(d) == 1 else "s"}, {text}'
+    return text
 
 
 def generate_output_name(text='output'):
     """Generate output name based on current time."""
-    time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    return f'{text}_{time}'
+    return generate_output_names((text,))[0]
+
+
+# Timestamp of output names, formatted once per second
+_last_name_sec = None
+_last_name_stamp = ''
+
+
+def generate_output_names(texts):
+    """Generate output names based on current time (same timestamp for all names)."""
+    global _last_name_sec, _last_name_stamp
+    sec = int(time.time())
+    if sec != _last_name_sec:
+        _last_name_stamp = time.strftime('%Y-%m-%d_%H-%M-%S', time.localtime(sec))
+        _last_name_sec = sec
+    return [f'{text}_{_last_name_stamp}' for text in texts]
 
 
 def check_path(path):
     """Check path and create missing folders if incorrect. Return path object."""
-    Path(path).mkdir(parents=True, exist_ok=True)
+    os.makedirs(path, exist_ok=True)
     return Path(path)
\ No newline at end of file